@@ -2,8 +2,12 @@
 
 import requests
 from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import gzip
 import json
 import os
+import sys
 import time
 
 # --- 配置 ---
@@ -12,59 +16,164 @@ TOTAL_LESSONS = 96
 BASE_URL = "http://www.newconceptenglish.com/index.php"
 OUTPUT_DIR = os.path.join("raw_data", f"nce_book_{BOOK_TO_SCRAPE}")
 MAX_ATTEMPTS = 3 # 每篇课文最多尝试次数
+ARCHIVE_DIR = "raw_html" # 原始HTML存档目录，每册一个压缩文件 + 一个索引
+RE_EXTRACT_WORKERS = os.cpu_count() or 4 # re-extract模式的进程数
 # ------------
 
-def scrape_nce_lesson(lesson_url):
+class HtmlArchive:
     """
-    核心爬虫函数：仅负责从URL获取内容，不包含打印逻辑。
-    返回一个包含内容的字典，或在失败时返回None。
+    原始网页存档（WARC风格）：每次成功抓取的响应都作为一个独立的gzip成员追加到
+    nce_book_N.warc.gz 中，索引文件记录每条记录的偏移量、长度和抓取元数据。
+    解析器修改后可以直接用 re-extract 模式离线重跑，无需重新下载。
+    """
+
+    def __init__(self, book_num, archive_dir=ARCHIVE_DIR):
+        self.archive_path = os.path.join(archive_dir, f"nce_book_{book_num}.warc.gz")
+        self.index_path = os.path.join(archive_dir, f"nce_book_{book_num}.index.json")
+        self.records = {} # url -> [记录元数据, ...]，按抓取时间先后排列
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.records = json.load(f)
+
+    def append(self, url, response):
+        """把一次HTTP响应追加到存档中，并更新索引"""
+        fetched_at = datetime.now(timezone.utc).isoformat()
+        body = response.content
+        header = (
+            "WARC/1.0\r\n"
+            "WARC-Type: response\r\n"
+            f"WARC-Target-URI: {url}\r\n"
+            f"WARC-Date: {fetched_at}\r\n"
+            f"HTTP-Status: {response.status_code}\r\n"
+            f"Content-Type: {response.headers.get('Content-Type', '')}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode('utf-8')
+        member = gzip.compress(header + body + b"\r\n\r\n")
+
+        os.makedirs(os.path.dirname(self.archive_path), exist_ok=True)
+        with open(self.archive_path, 'ab') as f:
+            offset = f.tell()
+            f.write(member)
+        self.records.setdefault(url, []).append({
+            "offset": offset,
+            "length": len(member),
+            "fetched_at": fetched_at,
+            "status": response.status_code,
+            "content_length": len(body),
+            "elapsed": round(response.elapsed.total_seconds(), 3),
+        })
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.records, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def latest(self, url):
+        """返回某个URL最近一次抓取的记录元数据，没有则返回None"""
+        records = self.records.get(url)
+        return records[-1] if records else None
+
+
+def read_archived_html(archive_path, offset, length):
+    """按偏移量读取一条存档记录，返回解码后的HTML文本"""
+    with open(archive_path, 'rb') as f:
+        f.seek(offset)
+        record = gzip.decompress(f.read(length))
+    _, body = record.split(b"\r\n\r\n", 1)
+    return body[:-len(b"\r\n\r\n")].decode('utf-8', errors='replace')
+
+
+def parse_nce_lesson_html(html):
+    """
+    解析函数：从页面HTML中提取课文、翻译和生词，不涉及网络。
+    返回一个包含内容的字典，或在核心内容缺失时返回None。
     """
+    soup = BeautifulSoup(html, 'html.parser')
+
+    content = {'english': '', 'chinese': '', 'vocabulary': ''}
+    h3_english = soup.find('h3', string='新概念英语－课文')
+    if h3_english and h3_english.find_next_sibling('p'):
+        content['english'] = h3_english.find_next_sibling('p').get_text(strip=True)
+
+    h3_chinese = soup.find('h3', string='新概念英语－翻译')
+    if h3_chinese and h3_chinese.find_next_sibling('p'):
+        content['chinese'] = h3_chinese.find_next_sibling('p').get_text(strip=True)
+        
+    h3_vocab = soup.find('h3', string='新概念英语－单词和短语')
+    if h3_vocab:
+        vocab_parts = []
+        for sibling in h3_vocab.next_siblings:
+            if sibling.name == 'h3': break
+            if isinstance(sibling, str):
+                cleaned_text = sibling.strip()
+                if cleaned_text: vocab_parts.append(cleaned_text)
+        content['vocabulary'] = '\n'.join(vocab_parts)
+    
+    # 只要核心内容不为空，就认为本次解析是初步成功的
+    if content['english'] and content['chinese']:
+        return content
+    else:
+        return None
+
+def fetch_lesson_page(lesson_url):
+    """只负责下载页面，返回HTTP响应，或在失败时返回None"""
     try:
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
         response = requests.get(lesson_url, headers=headers, timeout=20)
         response.raise_for_status()
         response.encoding = 'utf-8'
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        content = {'english': '', 'chinese': '', 'vocabulary': ''}
-        h3_english = soup.find('h3', string='新概念英语－课文')
-        if h3_english and h3_english.find_next_sibling('p'):
-            content['english'] = h3_english.find_next_sibling('p').get_text(strip=True)
-
-        h3_chinese = soup.find('h3', string='新概念英语－翻译')
-        if h3_chinese and h3_chinese.find_next_sibling('p'):
-            content['chinese'] = h3_chinese.find_next_sibling('p').get_text(strip=True)
-            
-        h3_vocab = soup.find('h3', string='新概念英语－单词和短语')
-        if h3_vocab:
-            vocab_parts = []
-            for sibling in h3_vocab.next_siblings:
-                if sibling.name == 'h3': break
-                if isinstance(sibling, str):
-                    cleaned_text = sibling.strip()
-                    if cleaned_text: vocab_parts.append(cleaned_text)
-            content['vocabulary'] = '\n'.join(vocab_parts)
-        
-        # 只要核心内容不为空，就认为本次爬取是初步成功的
-        if content['english'] and content['chinese']:
-            return content
-        else:
-            return None
+        return response
     except Exception:
         # 隐藏具体错误，让调用者处理重试
         return None
 
-def process_single_lesson(lesson_num, book_num):
+def parse_lesson_response(response):
+    """解析已下载的响应，解析出错或内容缺失时返回None"""
+    if response is None:
+        return None
+    try:
+        return parse_nce_lesson_html(response.text)
+    except Exception:
+        return None
+
+def scrape_nce_lesson(lesson_url):
+    """
+    核心爬虫函数：仅负责从URL获取内容，不包含打印逻辑。
+    返回一个包含内容的字典，或在失败时返回None。
+    """
+    return parse_lesson_response(fetch_lesson_page(lesson_url))
+
+def lesson_url_for(book_num, lesson_num):
+    return f"{BASE_URL}?id=course-{book_num}-{lesson_num:03d}"
+
+def archive_existing_lesson(lesson_num, lesson_url, archive):
+    """
+    补充存档：JSON已存在但存档里还没有这一课时，只抓取一次原始页面写入存档，不改动已有的JSON。
+    这样旧的raw_data目录也能直接使用 re-extract 模式。
+    """
+    print(f"📦 lesson_{lesson_num:03d}.json 已存在但尚未存档，正在补充存档...")
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        response = fetch_lesson_page(lesson_url)
+        if response is not None:
+            archive.append(lesson_url, response) # 磁盘错误直接抛出，不当作网络失败重试
+            print("    - 💾 已写入存档。")
+            time.sleep(1) # 友好访问
+            return True
+        print(f"    - ❌ 第 {attempt}/{MAX_ATTEMPTS} 次抓取失败，稍后重试...")
+        time.sleep(2)
+    print(f"  - ⚠️ Lesson {lesson_num} 补充存档失败（raw_data中的JSON不受影响）。")
+    return False
+
+def process_single_lesson(lesson_num, book_num, archive=None):
     """
     处理单篇课文的完整流程：爬取 -> 在线校验 -> 失败重试 -> 保存。
-    这是脚本的核心“自修正”逻辑。
+    这是脚本的核心“自修正”逻辑。只有最终被保存的那次响应会写入存档。
     """
     output_filepath = os.path.join(OUTPUT_DIR, f"lesson_{lesson_num:03d}.json")
+    lesson_url = lesson_url_for(book_num, lesson_num)
     if os.path.exists(output_filepath):
         print(f"✅ lesson_{lesson_num:03d}.json 已存在，跳过。")
         return True
 
-    lesson_url = f"{BASE_URL}?id=course-{book_num}-{lesson_num:03d}"
     print(f"\n--- 正在处理 Lesson {lesson_num} ---")
 
     for attempt in range(1, MAX_ATTEMPTS + 1):
@@ -72,7 +181,8 @@ def process_single_lesson(lesson_num, book_num):
         
         # 1. 首次爬取
         print("    - 正在爬取主要数据...")
-        main_data = scrape_nce_lesson(lesson_url)
+        main_response = fetch_lesson_page(lesson_url)
+        main_data = parse_lesson_response(main_response)
         if not main_data:
             print("    - ❌ 爬取失败，稍后重试...")
             time.sleep(2) # 等待2秒再重试
@@ -93,6 +203,8 @@ def process_single_lesson(lesson_num, book_num):
             main_data['vocabulary'] == verify_data['vocabulary']):
             
             print("    - ✅ 数据一致性校验通过！内容完整。")
+            if archive is not None:
+                archive.append(lesson_url, main_response) # 磁盘错误直接抛出，不当作网络失败重试
             try:
                 with open(output_filepath, 'w', encoding='utf-8') as f:
                     json.dump(main_data, f, ensure_ascii=False, indent=4)
@@ -110,16 +222,78 @@ def process_single_lesson(lesson_num, book_num):
     print(f"  - ❌ Lesson {lesson_num} 在 {MAX_ATTEMPTS} 次尝试后仍无法稳定抓取，已跳过。")
     return False # 所有尝试都失败了，返回False
 
+def re_extract_lesson(job):
+    """进程池中的工作函数：从存档读取HTML并重新解析，完全不联网"""
+    lesson_num, archive_path, offset, length = job
+    try:
+        html = read_archived_html(archive_path, offset, length)
+        return lesson_num, parse_nce_lesson_html(html)
+    except Exception:
+        return lesson_num, None
+
+def re_extract_from_archive(book_num):
+    """re-extract模式：用当前的解析器离线重跑存档中的所有页面，覆盖输出的JSON"""
+    print("♻️ 脚本1：re-extract 模式，从本地存档重新解析（不联网）♻️")
+    archive = HtmlArchive(book_num)
+    if not os.path.exists(archive.archive_path):
+        print(f"❌ 未找到存档文件: {archive.archive_path}，请先正常运行一次爬虫。")
+        return
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    jobs, missing_lessons = [], []
+    for lesson_num in range(1, TOTAL_LESSONS + 1):
+        record = archive.latest(lesson_url_for(book_num, lesson_num))
+        if record is None:
+            missing_lessons.append(lesson_num)
+            continue
+        jobs.append((lesson_num, archive.archive_path, record['offset'], record['length']))
+
+    start_time = time.time()
+    changed, unchanged, failed_lessons = 0, 0, []
+    with ProcessPoolExecutor(max_workers=RE_EXTRACT_WORKERS) as executor:
+        for lesson_num, content in executor.map(re_extract_lesson, jobs):
+            if not content:
+                failed_lessons.append(lesson_num)
+                continue
+            output_filepath = os.path.join(OUTPUT_DIR, f"lesson_{lesson_num:03d}.json")
+            if os.path.exists(output_filepath):
+                with open(output_filepath, 'r', encoding='utf-8') as f:
+                    if json.load(f) == content:
+                        unchanged += 1
+                        continue
+            with open(output_filepath, 'w', encoding='utf-8') as f:
+                json.dump(content, f, ensure_ascii=False, indent=4)
+            changed += 1
+
+    print("\n" + "#"*50)
+    print(f"📊 重新解析了 {len(jobs)} 篇课文，耗时 {time.time() - start_time:.1f} 秒。")
+    print(f"   - 内容有更新: {changed} 篇，内容不变: {unchanged} 篇。")
+    if failed_lessons:
+        print(f"❌ 解析失败的课文编号: {sorted(failed_lessons)}")
+    if missing_lessons:
+        print(f"⚠️ 存档中没有的课文编号（需要联网重新爬取）: {missing_lessons}")
+    print("#"*50 + "\n")
+
 def main():
     """主执行函数，负责调度整个爬取流程"""
+    if len(sys.argv) > 1 and sys.argv[1] == 're-extract':
+        re_extract_from_archive(BOOK_TO_SCRAPE)
+        return
+
     print("🚀 脚本1：新概念英语自我修正爬虫 🚀")
     os.makedirs(OUTPUT_DIR, exist_ok=True)
+    archive = HtmlArchive(BOOK_TO_SCRAPE)
     
-    failed_lessons = []
+    failed_lessons, unarchived_lessons = [], []
     for lesson_num in range(1, TOTAL_LESSONS + 1):
-        success = process_single_lesson(lesson_num, BOOK_TO_SCRAPE)
+        success = process_single_lesson(lesson_num, BOOK_TO_SCRAPE, archive)
         if not success:
             failed_lessons.append(lesson_num)
+            continue
+        # 早先抓取、尚未存档的课文补充存档，失败不影响课文本身
+        lesson_url = lesson_url_for(BOOK_TO_SCRAPE, lesson_num)
+        if archive.latest(lesson_url) is None and not archive_existing_lesson(lesson_num, lesson_url, archive):
+            unarchived_lessons.append(lesson_num)
     
     # --- 最终报告 ---
     print("\n" + "#"*50)
@@ -130,6 +304,9 @@ def main():
         print(f"❌ 注意：有 {len(failed_lessons)} 篇课文在多次尝试后依然失败。")
         print(f"失败的课文编号: {failed_lessons}")
         print("建议您检查网络或稍后重新运行脚本，程序会自动尝试这些失败的课文。")
+    if unarchived_lessons:
+        print(f"⚠️ 以下课文已抓取但尚未存档，re-extract 模式暂时无法处理它们: {unarchived_lessons}")
+        print("重新运行脚本即可再次尝试补充存档。")
     print("#"*50 + "\n")
 
 
@@ -2,9 +2,15 @@
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import json
+import math
 import os
+import re
+import threading
 import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dotenv import load_dotenv
+from google.api_core.exceptions import DeadlineExceeded
 
 # --- 配置 ---
 load_dotenv() 
@@ -12,8 +18,35 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 BOOK_TO_PROCESS = 2
 RAW_DATA_DIR = os.path.join("raw_data", f"nce_book_{BOOK_TO_PROCESS}")
 PROCESSED_DATA_DIR = os.path.join("processed_data", f"nce_book_{BOOK_TO_PROCESS}")
+IMPORTED_DATA_DIR = os.path.join(PROCESSED_DATA_DIR, "imported") # 脚本3导入后会把文件移到这里
+INDEX_FILEPATH = os.path.join(PROCESSED_DATA_DIR, ".lesson_index.json") # 以.开头，脚本3会忽略它
+RETRIEVAL_TOP_K = 6 # 精炼时每句最多参考的相关句子数
+DRAFT_FAILED_NOTE = "草稿生成失败。" # 失败时的占位笔记，不会作为关联内容进入索引
+REFINE_FAILED_PREFIX = "精炼失败，保留草稿："
+
+# 请求对冲（hedging）与超时配置
+STAGE_TIMEOUTS = {"split": 120, "draft": 120, "refine": 180} # 每次调用的最长等待时间（秒）
+DEFAULT_HEDGE_DELAYS = {"split": 30, "draft": 30, "refine": 60} # 样本不足时的对冲触发时间（秒）
+HEDGE_MIN_SAMPLES = 5 # 至少积累这么多次耗时样本后才使用p95
+LATENCY_WINDOW = 50 # 每个阶段保留最近多少次耗时用于计算p95
+MAX_HEDGE_RATE = 0.1 # 对冲请求最多占总调用数的比例
+HEDGE_DELAY_MAX_FRACTION = 0.5 # 对冲触发时间最多为本次超时时间的一半，保证对冲请求还有机会胜出
+HEDGE_MIN_REMAINING_FRACTION = 0.25 # 剩余时间不足超时时间的这个比例时不再发对冲请求
+# 每课的时间预算 = 基础预算（用于分句） + 每句预算 × 句子数，长课文会自动获得更多时间。
+# 注意：超出预算的课文不会保存，下次运行会从头重新处理；如果某课每次都超出预算，它会被一直重试，
+# 这时请调大每句预算。
+LESSON_DEADLINE_BASE_SECONDS = 300
+LESSON_DEADLINE_PER_SENTENCE_SECONDS = 150
 
 GENERATION_CONFIG = {"temperature": 0.4, "top_p": 1, "top_k": 1, "max_output_tokens": 8000}
+
+# 模型路由配置：简单句交给lite模型，复杂句或lite输出不合格时才用完整模型
+LITE_MODEL_NAME = "gemini-2.5-flash-lite"
+FULL_MODEL_NAME = "gemini-2.5-flash"
+MODEL_PRICES = {LITE_MODEL_NAME: (0.10, 0.40), FULL_MODEL_NAME: (0.30, 2.50)} # 每百万token的美元价格 (输入, 输出)
+ROUTING_COMPLEXITY_THRESHOLD = 2.5 # 复杂度得分达到该值的句子直接使用完整模型
+MIN_NOTE_LENGTH = 40 # 笔记少于这么多字视为不合格，需要用完整模型重做
+ROUTING_LOG_FILEPATH = os.path.join(PROCESSED_DATA_DIR, ".routing_log.jsonl") # 每次路由决策及其耗时、成本
 # ------------
 safety_settings = {
     HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
@@ -56,7 +89,7 @@ prompt_for_refinement = (
     "你是一位顶级的英语教学编辑，你的任务是“精炼并关联”一份笔记草稿。\n\n"
     "核心原则：\n"
     "1. **精炼简洁**: 严格遵守“少即是多”，删除草稿中所有非必要的、重复的或过于基础的信息。最终笔记要简明扼要，不要给初学者造成负担。\n"
-    "2. **深度关联**: 这是你的核心价值。请仔细阅读下面提供的“本课所有其他句子的笔记草稿”，如果当前句子的知识点（词汇/句型）与它们有关联，请用“这和我们之前遇到的...类似”或“注意区分...”等方式点明，帮助学生建立联系。\n"
+    "2. **深度关联**: 这是你的核心价值。请仔细阅读下面提供的“相关句子笔记”（每条都标注了所在课文），如果当前句子的知识点（词汇/句型）与它们有关联，请用“这和我们之前遇到的...类似”或“注意区分...”等方式点明，帮助学生建立联系。\n"
     "3. **优化表达**: 用更生动、更易于理解的方式重写草稿，确保最终版本清晰、流畅。\n\n"
     "输出格式：纯文本，用数字前缀分点。绝对不要使用markdown格式！！！！！也不要使用\n的格式！！！！！注意精炼之后每一句的字数不能超过100字！！！！关联开始的时候只需要标注【关联点】即可\n"
     "------------------------------------------------------------------\n"
@@ -67,7 +100,7 @@ prompt_for_refinement = (
     "--- 草稿开始 ---\n"
     "{draft_note}\n"
     "--- 草稿结束 ---\n\n"
-    "【重要参考】本课所有其他句子的笔记草稿（供你寻找关联点）:\n"
+    "【重要参考】与当前句子最相关的其他句子笔记，可能来自本课或本册其他课文（供你寻找关联点）:\n"
     "--- 全文背景开始 ---\n"
     "{full_context}\n"
     "--- 全文背景结束 ---\n\n"
@@ -75,16 +108,509 @@ prompt_for_refinement = (
 )
 
 
-def process_lesson_with_gemini(lesson_data):
+# <<< 新增：请求对冲，减少个别慢请求拖住整课的情况 >>>
+class LessonDeadlineExceeded(TimeoutError):
+    """本课的时间预算已用完，整课应放弃并在下次运行时重试"""
+
+
+def is_timeout_error(error):
+    """SDK的超时（DeadlineExceeded）和内置的TimeoutError都视为超时"""
+    return isinstance(error, (TimeoutError, DeadlineExceeded))
+
+
+class HedgedGenerator:
+    """
+    包装 model.generate_content：按阶段统计耗时p95，调用超过p95仍未返回时再发一个相同的请求，
+    谁先成功就用谁。SDK的同步调用无法中途打断，落败的请求会被放弃，由它自己的timeout兜底结束。
+    """
+
+    def __init__(self, max_workers=8):
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self.stats = defaultdict(Counter) # "阶段/模型" -> {calls, hedges_fired, hedges_won, timeouts, failures, deadline}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def p95(self, key):
+        with self._lock:
+            samples = sorted(self.latencies[key])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[math.ceil(0.95 * len(samples)) - 1]
+
+    def hedge_delay(self, key, stage, timeout):
+        p95 = self.p95(key)
+        delay = p95 if p95 is not None else DEFAULT_HEDGE_DELAYS[stage]
+        return min(delay, HEDGE_DELAY_MAX_FRACTION * timeout)
+
+    def _may_hedge(self):
+        with self._lock:
+            calls = sum(c['calls'] for c in self.stats.values())
+            hedges = sum(c['hedges_fired'] for c in self.stats.values())
+        return hedges < max(1, MAX_HEDGE_RATE * calls)
+
+    def _attempt(self, model, prompt, key, timeout):
+        start = time.monotonic()
+        try:
+            response = model.generate_content(prompt, request_options={"timeout": timeout})
+            response.text # 在工作线程里访问，被拦截或为空的响应会在这里抛错
+        except Exception as e:
+            # 真正超时的请求按超时时间计入样本，否则p95会漏掉最慢的那部分
+            if is_timeout_error(e):
+                with self._lock:
+                    self.latencies[key].append(max(time.monotonic() - start, timeout))
+            raise
+        with self._lock:
+            self.latencies[key].append(time.monotonic() - start)
+        return response
+
+    def generate(self, model, prompt, stage, deadline=None):
+        """
+        发起一次带对冲的调用。deadline 为本课时间预算的截止时刻（time.monotonic()）。
+        耗时按“阶段/模型”分别统计，不同模型的p95互不干扰。
+        成功时返回 (响应, 实际发出的请求数)，对冲时请求数为2，落败的请求同样会被计费。
+        超时抛出 TimeoutError，本课预算用完时抛出 LessonDeadlineExceeded，两个请求都失败时抛出最后一个错误。
+        """
+        key = f"{stage}/{getattr(model, 'model_name', '').replace('models/', '')}"
+        timeout = STAGE_TIMEOUTS[stage]
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                # 没有真正发出请求，不计入calls/timeouts
+                with self._lock:
+                    self.stats[key]['deadline'] += 1
+                raise LessonDeadlineExceeded("本课的时间预算已用完")
+        with self._lock:
+            self.stats[key]['calls'] += 1
+        end = time.monotonic() + timeout
+
+        pending = {self._executor.submit(self._attempt, model, prompt, key, timeout): "primary"}
+        attempts = 1
+        hedge_delay = self.hedge_delay(key, stage, timeout)
+        done, _ = wait(list(pending), timeout=hedge_delay)
+        remaining = end - time.monotonic()
+        if not done and remaining >= HEDGE_MIN_REMAINING_FRACTION * timeout and self._may_hedge():
+            with self._lock:
+                self.stats[key]['hedges_fired'] += 1
+            print(f"    - ⏱️ 已超过 {hedge_delay:.1f} 秒未返回，发出对冲请求...")
+            pending[self._executor.submit(self._attempt, model, prompt, key, remaining)] = "hedge"
+            attempts += 1
+
+        errors = []
+        while pending:
+            done, _ = wait(list(pending), timeout=max(0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                role = pending.pop(future)
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if role == "hedge":
+                        with self._lock:
+                            self.stats[key]['hedges_won'] += 1
+                    return future.result(), attempts
+                errors.append(future.exception())
+        for loser in pending:
+            loser.cancel()
+        # 按异常类型区分超时和其他失败：SDK超时通常会让future带着DeadlineExceeded结束，而不是一直挂起
+        timed_out = bool(pending) or any(is_timeout_error(e) for e in errors)
+        with self._lock:
+            self.stats[key]['timeouts' if timed_out else 'failures'] += 1
+        if deadline is not None and time.monotonic() >= deadline:
+            raise LessonDeadlineExceeded(f"{stage} 调用时本课的时间预算已用完")
+        if timed_out or not errors:
+            raise TimeoutError(f"{stage} 调用超过 {timeout:.0f} 秒未返回")
+        raise errors[-1]
+
+    def report(self):
+        """返回每个阶段的调用统计，便于打印"""
+        lines = []
+        with self._lock:
+            keys = sorted(self.stats)
+        for key in keys:
+            c = self.stats[key]
+            p95 = self.p95(key)
+            p95_text = f"{p95:.1f}s" if p95 is not None else "样本不足"
+            lines.append(f"   - [{key}] 调用 {c['calls']} 次，p95 {p95_text}，对冲 {c['hedges_fired']} 次（胜出 {c['hedges_won']} 次），超时 {c['timeouts']} 次，失败 {c['failures']} 次，预算用完未发出 {c['deadline']} 次")
+        return lines
+
+
+gemini_caller = HedgedGenerator()
+
+
+# <<< 新增：全书跨课检索索引，为【关联点】提供最相关的句子 >>>
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "but", "of", "to", "in", "on", "at", "for", "with", "by", "from",
+    "is", "am", "are", "was", "were", "be", "been", "it", "he", "she", "they", "we", "you", "i",
+    "his", "her", "its", "their", "our", "my", "your", "me", "him", "them", "us", "this", "that",
+    "not", "do", "did", "does", "have", "has", "had", "will", "would", "can", "could", "so", "as",
+}
+POS_MARKERS = {"n", "v", "vt", "vi", "adj", "adv", "prep", "conj", "pron", "int", "num", "art", "aux", "pl"}
+NOTE_TERM_WEIGHT = 0.3 # 笔记中出现的英文词权重低于句子本身
+VOCAB_TERM_BOOST = 2.0 # 命中各课生词表的词元加权
+
+
+def lemmatize(word):
+    """粗略的词形还原：只要建索引和查询用同一套规则，就能把同一单词的不同词形归到一起"""
+    word = word.lower().strip("'")
+    if word.endswith("'s"):
+        word = word[:-2]
+    if word.endswith("ss"):
+        return word
+    for suffix, replacement in (("ies", "y"), ("ied", "y"), ("sses", "ss"), ("ches", "ch"), ("shes", "sh"), ("xes", "x"),
+                                ("ing", ""), ("ed", ""), ("s", "")):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)] + replacement
+    return word
+
+
+def tokenize(text):
+    """从文本中提取英文词元（自动忽略中文部分和停用词）"""
+    lemmas = []
+    for word in re.findall(r"[A-Za-z][A-Za-z']*", text or ""):
+        if word.lower() in STOPWORDS:
+            continue
+        lemma = lemmatize(word)
+        if len(lemma) > 1:
+            lemmas.append(lemma)
+    return lemmas
+
+
+def extract_vocab_terms(vocabulary):
+    """从课文的生词表中提取英文词元，去掉 n. / adj. 这样的词性标记"""
+    terms = set()
+    for line in (vocabulary or '').split('\n'):
+        line = re.sub(r"\b[A-Za-z]{1,4}\.", lambda m: '' if m.group(0)[:-1].lower() in POS_MARKERS else m.group(0), line)
+        terms.update(tokenize(line))
+    return terms
+
+
+class LessonIndex:
+    """
+    全书的倒排索引：词元 -> 课文/句子，并为每个句子维护一个稀疏TF-IDF向量。
+    每处理完一课就增量更新，精炼时只需检索top-k个最相关的句子，而不是把本课所有草稿都塞进Prompt。
+    """
+
+    def __init__(self):
+        self.docs = {}                      # doc_id -> {"lesson", "english", "chinese", "note"}
+        self.lesson_vocab = {}              # lesson_num -> 该课生词词元列表
+        self.postings = defaultdict(dict)   # 词元 -> {doc_id: 词频权重}
+        self.doc_terms = {}                 # doc_id -> {词元: 词频权重}
+        self._vocab_terms = set()
+        self._norms = None                  # 文档向量长度缓存，索引变化后重新计算
+
+    def has_lesson(self, lesson_num):
+        return lesson_num in self.lesson_vocab
+
+    def remove_lesson(self, lesson_num):
+        for doc_id in [d for d, doc in self.docs.items() if doc['lesson'] == lesson_num]:
+            for term in self.doc_terms.pop(doc_id):
+                self.postings[term].pop(doc_id, None)
+                if not self.postings[term]:
+                    del self.postings[term]
+            del self.docs[doc_id]
+        if self.lesson_vocab.pop(lesson_num, None) is not None:
+            self._vocab_terms = {t for terms in self.lesson_vocab.values() for t in terms}
+        self._norms = None
+
+    def add_lesson(self, lesson_num, notes, vocabulary=''):
+        """
+        加入（或替换）一整课的句子，notes 为 [{"english", "chinese", "note"}, ...]。
+        生成失败的占位笔记只索引英文句子本身，不会被当作关联内容。
+        """
+        self.remove_lesson(lesson_num)
+        self.lesson_vocab[lesson_num] = sorted(extract_vocab_terms(vocabulary))
+        self._vocab_terms.update(self.lesson_vocab[lesson_num])
+        for i, note in enumerate(notes):
+            doc_id = f"{lesson_num:03d}-{i:03d}"
+            self.docs[doc_id] = {
+                "lesson": lesson_num,
+                "english": note.get('english', ''),
+                "chinese": note.get('chinese', ''),
+                "note": '' if is_placeholder_note(note.get('note', '')) else note.get('note', ''),
+            }
+            self._index_doc(doc_id)
+        self._norms = None
+
+    def _index_doc(self, doc_id):
+        doc = self.docs[doc_id]
+        weights = Counter(tokenize(doc['english']))
+        for term in tokenize(doc['note']):
+            weights[term] += NOTE_TERM_WEIGHT
+        self.doc_terms[doc_id] = dict(weights)
+        for term, weight in weights.items():
+            self.postings[term][doc_id] = weight
+
+    def _term_weight(self, term):
+        """idf，命中生词表的词元额外加权"""
+        idf = math.log((len(self.docs) + 1) / (len(self.postings.get(term, ())) + 1)) + 1
+        return idf * VOCAB_TERM_BOOST if term in self._vocab_terms else idf
+
+    def _doc_norms(self):
+        if self._norms is None:
+            self._norms = {}
+            for doc_id, terms in self.doc_terms.items():
+                self._norms[doc_id] = math.sqrt(sum((w * self._term_weight(t)) ** 2 for t, w in terms.items())) or 1.0
+        return self._norms
+
+    def query(self, english, top_k=RETRIEVAL_TOP_K, exclude=None, max_lesson=None):
+        """
+        返回与给定英文句子最相关的top_k个句子（余弦相似度降序）。
+        exclude 为 (lesson_num, english)，用于排除句子本身；
+        max_lesson 限制只返回该课及之前的句子，避免关联到学生还没学过的课文。
+        """
+        query_terms = Counter(tokenize(english))
+        if not query_terms or not self.docs:
+            return []
+        norms = self._doc_norms()
+        scores = defaultdict(float)
+        query_norm = 0.0
+        for term, count in query_terms.items():
+            weight = self._term_weight(term)
+            query_norm += (count * weight) ** 2
+            for doc_id, doc_weight in self.postings.get(term, {}).items():
+                scores[doc_id] += count * doc_weight * weight * weight
+        query_norm = math.sqrt(query_norm) or 1.0
+
+        results = []
+        for doc_id, score in scores.items():
+            doc = self.docs[doc_id]
+            if exclude and (doc['lesson'], doc['english']) == tuple(exclude):
+                continue
+            if max_lesson is not None and doc['lesson'] > max_lesson:
+                continue
+            results.append((score / (norms[doc_id] * query_norm), doc_id))
+        results.sort(key=lambda item: (-item[0], item[1]))
+        return [dict(self.docs[doc_id], score=round(score, 4)) for score, doc_id in results[:top_k]]
+
+    def save(self, filepath):
+        data = {
+            "lessons": {str(n): terms for n, terms in self.lesson_vocab.items()},
+            "docs": self.docs,
+        }
+        tmp_filepath = filepath + ".tmp"
+        with open(tmp_filepath, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_filepath, filepath) # 原子替换，避免中断时索引文件损坏
+
+    @classmethod
+    def load(cls, filepath):
+        index = cls()
+        if not os.path.exists(filepath):
+            return index
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            print(f"⚠️ 索引文件损坏，将重新构建: {e}")
+            return index
+        index.lesson_vocab = {int(n): terms for n, terms in data.get("lessons", {}).items()}
+        index._vocab_terms = {t for terms in index.lesson_vocab.values() for t in terms}
+        index.docs = data.get("docs", {})
+        for doc_id in index.docs:
+            index._index_doc(doc_id)
+        return index
+
+
+def is_placeholder_note(note):
+    """判断是否为草稿/精炼失败时留下的占位笔记"""
+    return note == DRAFT_FAILED_NOTE or note.startswith(REFINE_FAILED_PREFIX)
+
+
+def lesson_num_from_filename(filename):
+    """lesson_001.json -> 1，无法解析时返回None"""
+    try:
+        return int(filename.split('_')[1].split('.')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def sync_index_with_processed_files(index):
+    """把已处理（包括已导入Anki）但尚未进入索引的课文补充进索引，返回新增的课数"""
+    added = 0
+    for directory in (PROCESSED_DATA_DIR, IMPORTED_DATA_DIR):
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            lesson_num = lesson_num_from_filename(filename)
+            if not filename.endswith('.json') or lesson_num is None or index.has_lesson(lesson_num):
+                continue
+            vocabulary = ''
+            raw_filepath = os.path.join(RAW_DATA_DIR, filename)
+            if os.path.exists(raw_filepath):
+                with open(raw_filepath, 'r', encoding='utf-8') as f:
+                    vocabulary = json.load(f).get('vocabulary', '')
+            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                index.add_lesson(lesson_num, json.load(f), vocabulary)
+            added += 1
+    return added
+
+
+def build_related_context(related_notes):
+    """把检索到的相关句子拼成精炼Prompt里的“全文背景”"""
+    if not related_notes:
+        return "（没有检索到相关句子）"
+    parts = []
+    for related in related_notes:
+        if related['note']:
+            parts.append(f"[Lesson {related['lesson']}] 句子: {related['english']}\n笔记: {related['note']}\n")
+        else:
+            parts.append(f"[Lesson {related['lesson']}] 句子: {related['english']}\n")
+    return "\n".join(parts)
+
+
+# <<< 新增：按句子复杂度在lite模型和完整模型之间路由 >>>
+CLAUSE_MARKERS = {
+    "which", "who", "whom", "whose", "when", "where", "while", "if", "unless", "because",
+    "although", "though", "whether",
+}
+# 这些词也常作限定词/介词（that book, before lunch），只有引导从句时才算满分
+AMBIGUOUS_CLAUSE_MARKERS = {"that", "as", "before", "after", "since", "until"}
+AMBIGUOUS_MARKER_WEIGHT = 0.25
+SUBJECT_PRONOUNS = {"i", "you", "he", "she", "it", "we", "they", "there", "this", "these", "those"}
+
+
+def sentence_complexity(english, vocab_terms):
+    """
+    本地估算句子复杂度：长度、从句引导词/标点、以及命中本课生词表的数量（生词越多越难）。
+    例如 "Last week I went to the theatre." 约为1分，带多个从句的长句通常在3分以上。
+    """
+    tokens = re.findall(r"[A-Za-z][A-Za-z']*|[,;:]", english)
+    words = [t for t in tokens if t[0].isalpha()]
+    punctuation = len(tokens) - len(words)
+    clause_markers = 0.0
+    for i, token in enumerate(tokens):
+        word = token.lower()
+        if word in CLAUSE_MARKERS:
+            clause_markers += 1
+        elif word in AMBIGUOUS_CLAUSE_MARKERS:
+            # 逗号之后或后面紧跟主语代词时才视为从句引导词
+            after_comma = i > 0 and tokens[i - 1] in ",;:"
+            before_subject = i + 1 < len(tokens) and tokens[i + 1].lower() in SUBJECT_PRONOUNS
+            clause_markers += 1 if after_comma or before_subject else AMBIGUOUS_MARKER_WEIGHT
+    rare_words = sum(1 for lemma in set(tokenize(english)) if lemma in vocab_terms)
+    return round(len(words) / 10 + clause_markers + 0.5 * punctuation + 0.5 * rare_words, 2)
+
+
+def is_valid_note(text):
+    """lite模型输出的基本校验：不能太短，也不能包含HTML标签"""
+    return len(text) >= MIN_NOTE_LENGTH and not re.search(r"</?[a-zA-Z]+[^>]*>", text)
+
+
+class ModelRouter:
+    """
+    为每个句子的草稿和精炼选择模型：简单句用lite模型，复杂句用完整模型；
+    lite模型出错或输出不合格时自动升级到完整模型重做。
+    每次决策连同耗时、token和成本追加写入 ROUTING_LOG_FILEPATH，便于按册统计吞吐收益。
+    """
+
+    def __init__(self, log_filepath=ROUTING_LOG_FILEPATH):
+        self.models = {
+            name: genai.GenerativeModel(model_name=name, generation_config=GENERATION_CONFIG)
+            for name in (LITE_MODEL_NAME, FULL_MODEL_NAME)
+        }
+        self.log_filepath = log_filepath
+        self.usage = defaultdict(Counter) # 模型名 -> {calls, seconds, input_tokens, output_tokens, cost}
+        self.decisions = Counter()        # lite / full / escalated
+
+    def call(self, model_name, prompt, stage, deadline=None):
+        """
+        调用指定模型并记录耗时与成本，返回 (文本, 本次调用的统计)。
+        对冲落败的请求拿不到用量数据，按与胜出请求相同的用量估算其成本。
+        """
+        start = time.monotonic()
+        response, attempts = gemini_caller.generate(self.models[model_name], prompt, stage, deadline)
+        usage = getattr(response, 'usage_metadata', None)
+        input_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        # 2.5系列的思考token按输出token计费
+        output_tokens = (getattr(usage, 'candidates_token_count', 0) or 0) + (getattr(usage, 'thoughts_token_count', 0) or 0)
+        input_price, output_price = MODEL_PRICES[model_name]
+        attempt_cost = (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+        record = {
+            "model": model_name,
+            "seconds": round(time.monotonic() - start, 3),
+            "attempts": attempts,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "extra_attempts_cost": attempt_cost * (attempts - 1),
+            "cost": attempt_cost * attempts,
+        }
+        self.usage[model_name].update({"calls": 1, "attempts": attempts, "seconds": record["seconds"], "input_tokens": input_tokens,
+                                       "output_tokens": output_tokens, "extra_attempts_cost": record["extra_attempts_cost"],
+                                       "cost": record["cost"]})
+        return response.text.strip(), record
+
+    def generate_note(self, prompt, stage, english, vocab_terms, deadline=None, lesson_num=None):
+        """按复杂度路由一次草稿/精炼调用，失败时抛出完整模型的错误"""
+        score = sentence_complexity(english, vocab_terms)
+        model_name = FULL_MODEL_NAME if score >= ROUTING_COMPLEXITY_THRESHOLD else LITE_MODEL_NAME
+        calls = []
+        text, escalated, outcome = None, False, None
+        try:
+            if model_name == LITE_MODEL_NAME:
+                try:
+                    text, record = self.call(LITE_MODEL_NAME, prompt, stage, deadline)
+                    calls.append(record)
+                    if not is_valid_note(text):
+                        print(f"    - ⚠️ lite模型输出不合格，升级到 {FULL_MODEL_NAME} 重做...")
+                        text, escalated = None, True
+                except LessonDeadlineExceeded:
+                    raise # 预算用完与lite模型的质量无关，不升级
+                except Exception as e:
+                    print(f"    - ⚠️ lite模型调用失败 ({e})，升级到 {FULL_MODEL_NAME} 重做...")
+                    escalated = True
+            if text is None:
+                text, record = self.call(FULL_MODEL_NAME, prompt, stage, deadline)
+                calls.append(record)
+        except LessonDeadlineExceeded:
+            outcome = "deadline"
+            raise
+        finally:
+            if outcome is None:
+                outcome = "escalated" if escalated else ("lite" if model_name == LITE_MODEL_NAME else "full")
+            self.decisions[outcome] += 1
+            print(f"    - 🧭 路由: 复杂度 {score} -> {model_name}{'（已升级）' if escalated else ''}{'（预算用完）' if outcome == 'deadline' else ''}")
+            self._log({
+                "book": BOOK_TO_PROCESS, "lesson": lesson_num, "stage": stage, "english": english,
+                "score": score, "routed_to": model_name, "escalated": escalated, "outcome": outcome,
+                "succeeded": text is not None, "calls": calls,
+            })
+        return text
+
+    def _log(self, entry):
+        if not self.log_filepath:
+            return
+        try:
+            with open(self.log_filepath, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except IOError as e:
+            print(f"    - ⚠️ 写入路由日志失败: {e}")
+
+    def report(self):
+        """返回路由决策和每个模型的耗时、成本统计，便于打印"""
+        lines = [f"   - 路由决策: lite {self.decisions['lite']} 次，完整模型 {self.decisions['full']} 次，升级 {self.decisions['escalated']} 次，预算用完 {self.decisions['deadline']} 次"]
+        for model_name in sorted(self.usage):
+            u = self.usage[model_name]
+            avg = u['seconds'] / u['calls'] if u['calls'] else 0
+            lines.append(f"   - [{model_name}] 调用 {u['calls']} 次（实际请求 {u['attempts']} 次），平均 {avg:.1f} 秒，输入 {u['input_tokens']} / 输出 {u['output_tokens']} token，"
+                         f"约 ${u['cost']:.4f}（其中对冲请求约 ${u['extra_attempts_cost']:.4f}）")
+        return lines
+
+
+def process_lesson_with_gemini(lesson_data, lesson_num=None, index=None, router=None):
     print("🤖 开始使用Gemini处理内容(两阶段精炼模式)...")
-    model = genai.GenerativeModel(model_name="gemini-2.5-flash", generation_config=GENERATION_CONFIG)
+    start_time = time.monotonic()
+    deadline = start_time + LESSON_DEADLINE_BASE_SECONDS # 分句前只有基础预算，分句后按句子数追加
+    router = router or ModelRouter()
+    vocab_terms = extract_vocab_terms(lesson_data.get('vocabulary', ''))
     
     # --- 准备阶段: 智能分句 ---
     prompt_split = f"你的任务是将一段英文和其对应的中文翻译，一句对一句地精准配对。请严格按照“英文句子 | 中文句子”的格式输出...\n\n现在请处理以下内容：\n英文课文:\n{lesson_data['english']}\n\n中文译文:\n{lesson_data['chinese']}"
     try:
-        response = model.generate_content(prompt_split)
+        # 分句需要整课对齐，始终使用完整模型
+        split_text, _ = router.call(FULL_MODEL_NAME, prompt_split, "split", deadline)
         sentence_pairs = []
-        for line in response.text.strip().split('\n'):
+        for line in split_text.split('\n'):
             if '|' in line:
                 parts = line.split('|', 1)
                 if len(parts) == 2:
@@ -94,6 +620,8 @@ def process_lesson_with_gemini(lesson_data):
         print(f"\n   - ❌ 调用Gemini分句时出错: {e}"); return None
     if not sentence_pairs:
         print("   - ⚠️ 未能成功配对句子，处理中断。"); return None
+    deadline = start_time + LESSON_DEADLINE_BASE_SECONDS + LESSON_DEADLINE_PER_SENTENCE_SECONDS * len(sentence_pairs)
+    print(f"   - ⏳ 本课时间预算: {deadline - start_time:.0f} 秒。")
 
     # --- 阶段1: 生成所有句子的笔记草稿 ---
     print("\n--- [阶段1: 正在生成草稿笔记，此阶段成本较低] ---")
@@ -107,28 +635,38 @@ def process_lesson_with_gemini(lesson_data):
                 chn=chn, 
                 vocabulary=lesson_data.get('vocabulary', '') # 使用.get以防万一没有'vocabulary'键
             )
-            response = model.generate_content(draft_prompt_filled)
-            draft_notes[eng] = response.text.strip()
+            draft_notes[eng] = router.generate_note(draft_prompt_filled, "draft", eng, vocab_terms, deadline, lesson_num)
+        except LessonDeadlineExceeded as e:
+            print(f"  - ⏰ {e}，放弃本课，下次运行时重新处理。"); return None
         except Exception as e:
             print(f"  - ❌ 生成草稿失败: {e}")
-            draft_notes[eng] = "草稿生成失败。"
+            draft_notes[eng] = DRAFT_FAILED_NOTE
         time.sleep(1)
     print("--- [阶段1: 所有草稿生成完毕] ---")
 
     # --- 阶段2: 精炼并关联笔记 ---
     print("\n--- [阶段2: 正在精炼并关联笔记，此阶段更智能] ---")
     final_notes_data = []
+    use_index = index is not None and lesson_num is not None
+    if use_index:
+        # 先把本课草稿放进索引，这样本课和其他课的句子都能被检索到
+        index.add_lesson(lesson_num, [{"english": eng, "chinese": chn, "note": draft_notes.get(eng, "")} for eng, chn in sentence_pairs], lesson_data.get('vocabulary', ''))
     for i, (eng, chn) in enumerate(sentence_pairs):
         print(f"  - 正在精炼第 {i+1}/{len(sentence_pairs)} 句的笔记...")
         
         draft_note_for_current_sentence = draft_notes.get(eng, "")
         
-        # 构建用于参考的“全文背景”
-        other_drafts = []
-        for other_eng, other_note in draft_notes.items():
-            if other_eng != eng:
-                other_drafts.append(f"句子: {other_eng}\n笔记草稿: {other_note}\n")
-        full_context = "\n".join(other_drafts)
+        # 构建用于参考的“全文背景”：有索引时只取全书最相关的top-k句
+        if use_index:
+            related_notes = index.query(eng, RETRIEVAL_TOP_K, exclude=(lesson_num, eng), max_lesson=lesson_num)
+            print(f"    - 🔗 检索到 {len(related_notes)} 个相关句子: {sorted({r['lesson'] for r in related_notes})}")
+            full_context = build_related_context(related_notes)
+        else:
+            other_drafts = []
+            for other_eng, other_note in draft_notes.items():
+                if other_eng != eng:
+                    other_drafts.append(f"句子: {other_eng}\n笔记草稿: {other_note}\n")
+            full_context = "\n".join(other_drafts)
 
         # 填充最终的精炼Prompt
         refinement_prompt_filled = prompt_for_refinement.format(
@@ -139,17 +677,24 @@ def process_lesson_with_gemini(lesson_data):
         )
         
         try:
-            response = model.generate_content(refinement_prompt_filled, request_options={"timeout": 180})
-            final_note = response.text.strip()
+            final_note = router.generate_note(refinement_prompt_filled, "refine", eng, vocab_terms, deadline, lesson_num)
             final_notes_data.append({"english": eng, "chinese": chn, "note": final_note})
+        except LessonDeadlineExceeded as e:
+            print(f"  - ⏰ {e}，放弃本课，下次运行时重新处理。")
+            if use_index:
+                index.remove_lesson(lesson_num) # 不让半成品留在索引里
+            return None
         except Exception as e:
             print(f"  - ❌ 精炼笔记失败: {e}")
             # 即使精炼失败，也保留草稿作为备用
-            final_notes_data.append({"english": eng, "chinese": chn, "note": f"精炼失败，保留草稿：\n{draft_note_for_current_sentence}"})
+            final_notes_data.append({"english": eng, "chinese": chn, "note": f"{REFINE_FAILED_PREFIX}\n{draft_note_for_current_sentence}"})
         time.sleep(1)
     print("--- [阶段2: 所有笔记精炼完毕] ---")
+    if use_index:
+        # 用精炼后的最终笔记替换索引中的草稿
+        index.add_lesson(lesson_num, final_notes_data, lesson_data.get('vocabulary', ''))
     
-    print("\n✅ 整篇课文处理完成。")
+    print(f"\n✅ 整篇课文处理完成，用时 {time.monotonic() - start_time:.0f} 秒。")
     return final_notes_data
 
 
@@ -163,6 +708,12 @@ def main():
     except Exception as e:
         print(f"❌ 初始化Gemini失败: {e}"); return
     os.makedirs(PROCESSED_DATA_DIR, exist_ok=True)
+    index = LessonIndex.load(INDEX_FILEPATH)
+    added = sync_index_with_processed_files(index)
+    if added:
+        index.save(INDEX_FILEPATH)
+    print(f"🔎 跨课检索索引已就绪: {len(index.lesson_vocab)} 课，{len(index.docs)} 句 (新增 {added} 课)。")
+    router = ModelRouter()
     raw_files = sorted([f for f in os.listdir(RAW_DATA_DIR) if f.endswith('.json')])
     for filename in raw_files:
         raw_filepath = os.path.join(RAW_DATA_DIR, filename)
@@ -176,12 +727,20 @@ def main():
             lesson_data = json.load(f)
         if not lesson_data.get('english') or not lesson_data.get('chinese'):
             print("   - ❌ 文件内容不完整，跳过。"); continue
-        anki_notes = process_lesson_with_gemini(lesson_data)
+        lesson_num = lesson_num_from_filename(filename)
+        anki_notes = process_lesson_with_gemini(lesson_data, lesson_num, index, router)
         if anki_notes:
             with open(processed_filepath, 'w', encoding='utf-8') as f:
                 json.dump(anki_notes, f, ensure_ascii=False, indent=4)
             print(f"💾 已将处理结果保存到: {processed_filepath}")
+            index.save(INDEX_FILEPATH)
     print("\n🏁 所有原始数据处理完毕！")
+    print("📈 Gemini调用统计:")
+    for line in gemini_caller.report():
+        print(line)
+    print("🧭 模型路由统计:")
+    for line in router.report():
+        print(line)
 
 
 if __name__ == '__main__':